@@ -1,5 +1,8 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 
 from ._config import config
 from .middlewares import AccessLogMiddleware
@@ -7,9 +10,25 @@ from .middlewares import AccessLogMiddleware
 
 api_docs_enabled = config.ENVIRONMENT == "local"
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Imported here since the services package depends on `main` being initialized
+    from main.services.coda_client import CodaClient
+
+    # One pooled Coda client is shared by all requests for the app's lifetime
+    app.state.coda_client = CodaClient(api_token=config.CODA_API_TOKEN)
+    yield
+    await app.state.coda_client.aclose()
+
+
 app = FastAPI(
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
     redoc_url=None,
     docs_url="/docs" if api_docs_enabled else None,
+    # Without docs the OpenAPI schema is never needed, so it is never built
+    openapi_url="/openapi.json" if api_docs_enabled else None,
 )
 
 app.add_middleware(
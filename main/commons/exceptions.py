@@ -1,5 +1,5 @@
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 
 from main.schemas.exceptions import ErrorSchema
 
@@ -67,7 +67,7 @@ class BaseError(Exception):
         )
 
     def to_response(self):
-        return JSONResponse(
+        return ORJSONResponse(
             ErrorSchema.model_validate(self).model_dump(mode="json"),
             self.status_code,
         )
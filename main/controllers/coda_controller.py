@@ -1,11 +1,11 @@
-from datetime import datetime, timedelta
+import time
+from collections import OrderedDict
 
 from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.security.api_key import APIKeyHeader
 
 from main._config import config
 from main.schemas.coda_schemas import MergeResult
-from main.services.table_merger import TableMerger
 
 
 router = APIRouter(prefix="/coda", tags=["coda"])
@@ -14,8 +14,13 @@ router = APIRouter(prefix="/coda", tags=["coda"])
 API_KEY_NAME = "X-API-Key"
 api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
 
-# Rate limiting storage - stores last request time for each API key
-rate_limit_store: dict[str, datetime] = {}
+# Minimum number of seconds between two requests with the same API key
+RATE_LIMIT_WINDOW = 60
+# Maximum number of API keys tracked, least recently seen keys are evicted first
+RATE_LIMIT_STORE_MAX_SIZE = 10_000
+
+# Rate limiting storage - stores last request time (monotonic clock) for each API key
+rate_limit_store: OrderedDict[str, float] = OrderedDict()
 
 
 async def get_api_key(api_key_header: str = Depends(api_key_header)):
@@ -29,16 +34,16 @@ async def get_api_key(api_key_header: str = Depends(api_key_header)):
 
 
 async def check_rate_limit(request: Request, api_key: str = Depends(get_api_key)):
-    # Get the current time
-    current_time = datetime.now()
-
-    # Check if this API key has made a request before
-    if api_key in rate_limit_store:
-        last_request_time = rate_limit_store[api_key]
-        # Check if the last request was less than 1 minute ago
-        if current_time - last_request_time < timedelta(minutes=1):
+    # Get the current time, unaffected by wall-clock adjustments
+    current_time = time.monotonic()
+
+    # Check if this API key has made a request within the rate limit window
+    last_request_time = rate_limit_store.get(api_key)
+    if last_request_time is not None:
+        elapsed = current_time - last_request_time
+        if elapsed < RATE_LIMIT_WINDOW:
             # Calculate remaining time until next allowed request
-            wait_time = 60 - (current_time - last_request_time).seconds
+            wait_time = RATE_LIMIT_WINDOW - int(elapsed)
             raise HTTPException(
                 status_code=429,
                 detail=f"Rate limit exceeded. Try again in {wait_time} seconds.",
@@ -46,13 +51,23 @@ async def check_rate_limit(request: Request, api_key: str = Depends(get_api_key)
 
     # Update the last request time for this API key
     rate_limit_store[api_key] = current_time
+    rate_limit_store.move_to_end(api_key)
+    while len(rate_limit_store) > RATE_LIMIT_STORE_MAX_SIZE:
+        rate_limit_store.popitem(last=False)
+
     return api_key
 
 
 @router.post("/merge", response_model=MergeResult)
-async def merge_tables(api_key: str = Depends(check_rate_limit)) -> MergeResult:
+async def merge_tables(
+    request: Request,
+    api_key: str = Depends(check_rate_limit),
+) -> MergeResult:
+    # Imported lazily to keep the merge service out of app start-up
+    from main.services.table_merger import TableMerger
+
     merger = TableMerger(
-        api_token=config.CODA_API_TOKEN,
+        coda_client=request.app.state.coda_client,
         destination_doc_id=config.MERGE_TABLE_CONFIG.destination_doc_id,
         destination_table_id=config.MERGE_TABLE_CONFIG.destination_table_id,
         source_tables=config.MERGE_TABLE_CONFIG.source_tables,
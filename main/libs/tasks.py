@@ -0,0 +1,32 @@
+import asyncio
+from collections.abc import Awaitable
+from typing import TypeVar
+
+
+T = TypeVar("T")
+
+
+async def gather_or_cancel(*aws: Awaitable[T]) -> list[T]:
+    """
+    Run awaitables concurrently and return their results in order.
+
+    Unlike asyncio.gather, as soon as one of them raises, the others are cancelled
+    and awaited before the exception propagates, so no work is left running.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    if not tasks:
+        return []
+
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        # Stop whatever is still running, after a failure or if we were cancelled
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    for task in tasks:
+        if not task.cancelled() and (exception := task.exception()):
+            raise exception
+
+    return [task.result() for task in tasks]
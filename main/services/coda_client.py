@@ -1,9 +1,14 @@
 import asyncio
+import random
+import urllib.request
 from typing import Any
+from urllib.parse import urlsplit
 
 import httpx
+import orjson
 
 from main.libs.log import get_logger
+from main.libs.tasks import gather_or_cancel
 
 
 logger = get_logger(__name__)
@@ -13,14 +18,54 @@ class CodaClient:
     """Client for interacting with the Coda API"""
 
     BASE_URL = "https://coda.io/apis/v1"
+    # Maximum number of rows Coda returns per page
+    ROWS_PAGE_SIZE = 200
+    # Number of times the transport retries a connection that couldn't be opened
+    CONNECT_RETRIES = 3
 
-    def __init__(self, api_token: str):
+    def __init__(
+        self,
+        api_token: str,
+        timeout: int = 300,
+        max_concurrent_writes: int = 5,
+    ):
         """Initialize the Coda API client"""
         self.api_token = api_token
         self.headers = {
             "Authorization": f"Bearer {self.api_token}",
             "Content-Type": "application/json",
         }
+        # Pooled HTTP/2 transport, retrying failed connection attempts itself.
+        # httpx ignores proxy environment variables when given a transport,
+        # so the proxy for the Coda host is passed explicitly.
+        transport = httpx.AsyncHTTPTransport(
+            retries=self.CONNECT_RETRIES,
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            proxy=self._get_environment_proxy(),
+        )
+        # Shared client so every request reuses pooled keep-alive connections
+        self._client = httpx.AsyncClient(
+            headers=self.headers,
+            timeout=timeout,  # 5 minutes in seconds by default
+            transport=transport,
+        )
+        # Bounds the number of row write batches sent to Coda at the same time
+        self._write_semaphore = asyncio.Semaphore(max_concurrent_writes)
+
+    @classmethod
+    def _get_environment_proxy(cls) -> str | None:
+        """Get the proxy for the Coda API from HTTPS_PROXY/ALL_PROXY/NO_PROXY"""
+        host = urlsplit(cls.BASE_URL).hostname or ""
+        if urllib.request.proxy_bypass(host):
+            return None
+
+        proxies = urllib.request.getproxies()
+        return proxies.get("https") or proxies.get("all")
+
+    async def aclose(self) -> None:
+        """Close the underlying HTTP client and its pooled connections"""
+        await self._client.aclose()
 
     def _log_request(
         self,
@@ -46,31 +91,37 @@ class CodaClient:
         data: dict[str, Any] | None = None,
         retry_count: int = 3,
         retry_delay: int = 1,
-        timeout: int = 300,  # 5 minutes in seconds
+        parse_response: bool = True,
     ) -> dict[str, Any]:
-        """Make an async request to the Coda API with retry logic for rate limits"""
+        """
+        Make an async request to the Coda API with retry logic for rate limits.
+
+        With parse_response=False the response body is not decoded and an empty
+        dict is returned, for callers that only care about the request succeeding.
+        """
         url = f"{self.BASE_URL}{endpoint}"
         logger.info(f"Making {method} request to: {url}")
 
         for attempt in range(1, retry_count + 1):
-            async with httpx.AsyncClient() as client:
-                response = await client.request(
-                    method=method,
-                    url=url,
-                    headers=self.headers,
-                    params=params,
-                    json=data,
-                    timeout=timeout,  # Add timeout parameter
-                )
+            response = await self._client.request(
+                method=method,
+                url=url,
+                params=params,
+                json=data,
+            )
 
             # Log response status for debugging
             logger.info(f"Response status: {response.status_code}")
 
             # Handle rate limiting
             if response.status_code == 429:
-                retry_after = int(response.headers.get("Retry-After", retry_delay))
+                # Back off exponentially unless Coda tells us how long to wait,
+                # with jitter so concurrently rate-limited requests spread out
+                backoff = retry_delay * 2 ** (attempt - 1)
+                retry_after: float = int(response.headers.get("Retry-After", backoff))
+                retry_after += random.uniform(0, retry_delay)  # noqa: S311
                 logger.warning(
-                    f"Rate limited. Waiting {retry_after} seconds... "
+                    f"Rate limited. Waiting {retry_after:.1f} seconds... "
                     f"(Attempt {attempt}/{retry_count})",
                 )
                 await asyncio.sleep(retry_after)
@@ -91,7 +142,10 @@ class CodaClient:
                 continue
 
             response.raise_for_status()
-            return response.json()
+            if not parse_response:
+                return {}
+            # orjson decodes the raw bytes directly, skipping the text round-trip
+            return orjson.loads(response.content)
 
         # If we've exhausted all retries
         logger.error(f"Request failed after {retry_count} attempts")
@@ -137,7 +191,7 @@ class CodaClient:
         loop_count = 0
         while True:
             params = {
-                "limit": 100,
+                "limit": self.ROWS_PAGE_SIZE,
                 "useColumnNames": True,
             }
 
@@ -187,27 +241,39 @@ class CodaClient:
         rows: list[dict[str, Any]],
         key_columns: list[str],
     ) -> None:
-        """Add or update rows in a table"""
+        """
+        Add or update rows in a table.
+
+        Rows sharing the same key column values are collapsed to the last of them
+        before sending, so fewer rows than given may be written.
+        """
         if not rows:
             logger.info("No rows to add")
             return
 
-        # Add rows in batches to avoid API limits
-        BATCH_SIZE = 40
-        for i in range(0, len(rows), BATCH_SIZE):
-            batch = rows[i : i + BATCH_SIZE]
-
-            # Make a copy of each row's values and remove any 'id' field
-            for row in batch:
-                if "id" in row["values"]:
-                    del row["values"]["id"]
-
+        # Rows sharing key values could be applied in any order by concurrent
+        # batches, so only the last of them is sent, as it wins when sent in order
+        last_row_by_key: dict[tuple[Any, ...], dict[str, Any]] = {}
+        unkeyed_rows: list[dict[str, Any]] = []
+        for row in rows:
+            key = tuple(row["values"].get(col) for col in key_columns)
+            if key_columns and None not in key:
+                last_row_by_key[key] = row
+            else:
+                unkeyed_rows.append(row)
+        rows = [*last_row_by_key.values(), *unkeyed_rows]
+
+        endpoint = f"/docs/{doc_id}/tables/{table_id}/rows"
+
+        async def add_batch(start: int, batch: list[dict[str, Any]]) -> None:
+            # Skip any 'id' field while building the payload, leaving rows untouched
             row_data = {
                 "rows": [
                     {
                         "cells": [
                             {"column": col, "value": val}
                             for col, val in row["values"].items()
+                            if col != "id"
                         ],
                     }
                     for row in batch
@@ -215,12 +281,25 @@ class CodaClient:
                 "keyColumns": key_columns,
             }
 
-            await self.make_request(
-                "POST",
-                f"/docs/{doc_id}/tables/{table_id}/rows",
-                data=row_data,
+            async with self._write_semaphore:
+                await self.make_request(
+                    "POST",
+                    endpoint,
+                    data=row_data,
+                    parse_response=False,
+                )
+            logger.info(
+                f"Added batch of {len(batch)} rows ({start+1} to {start+len(batch)})",
             )
-            logger.info(f"Added batch of {len(batch)} rows ({i+1} to {i+len(batch)})")
+
+        # Add rows in batches to avoid API limits, sending batches concurrently
+        BATCH_SIZE = 40
+        await gather_or_cancel(
+            *(
+                add_batch(i, rows[i : i + BATCH_SIZE])
+                for i in range(0, len(rows), BATCH_SIZE)
+            ),
+        )
 
         logger.info(f"Successfully added {len(rows)} rows to the destination table")
 
@@ -229,13 +308,25 @@ class CodaClient:
         if not row_ids:
             return
 
-        # Delete rows in batches
-        BATCH_SIZE = 40
-        for i in range(0, len(row_ids), BATCH_SIZE):
-            batch = row_ids[i : i + BATCH_SIZE]
-            await self.make_request(
-                "DELETE",
-                f"/docs/{doc_id}/tables/{table_id}/rows",
-                data={"rowIds": batch},
+        endpoint = f"/docs/{doc_id}/tables/{table_id}/rows"
+
+        async def delete_batch(start: int, batch: list[str]) -> None:
+            async with self._write_semaphore:
+                await self.make_request(
+                    "DELETE",
+                    endpoint,
+                    data={"rowIds": batch},
+                    parse_response=False,
+                )
+            logger.info(
+                f"Deleted batch of {len(batch)} rows ({start+1} to {start+len(batch)})",
             )
-            logger.info(f"Deleted batch of {len(batch)} rows ({i+1} to {i+len(batch)})")
+
+        # Delete rows in batches, sending batches concurrently
+        BATCH_SIZE = 40
+        await gather_or_cancel(
+            *(
+                delete_batch(i, row_ids[i : i + BATCH_SIZE])
+                for i in range(0, len(row_ids), BATCH_SIZE)
+            ),
+        )
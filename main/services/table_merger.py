@@ -1,9 +1,15 @@
-import hashlib
-import json
+import asyncio
 import re
-from typing import Any
+from collections import defaultdict
+from collections.abc import Awaitable, Callable
+from functools import lru_cache, partial
+from typing import Any, TypeVar
+
+import orjson
+import xxhash
 
 from main.libs.log import get_logger
+from main.libs.tasks import gather_or_cancel
 from main.schemas.coda_schemas import MergeResult
 from main.schemas.config import SourceTable
 from main.services.coda_client import CodaClient
@@ -11,19 +17,48 @@ from main.services.coda_client import CodaClient
 
 logger = get_logger(__name__)
 
+T = TypeVar("T")
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_REMOVED_CHARS = str.maketrans("", "", "/()")
+
+# Columns kept on source rows even when the destination schema doesn't list them
+_SPECIAL_COLUMNS = frozenset({"unique_key", "row_hash"})
+
+
+@lru_cache(maxsize=1024)
+def normalize_column_name(name: str) -> str:
+    """Lower-case a column name, drop special characters and normalize spaces"""
+    return _WHITESPACE_RE.sub(" ", name.lower().translate(_REMOVED_CHARS)).strip()
+
+
+class ColumnNameMap(dict[str, str]):
+    """Dict that resolves and caches the value of a missing key on first access"""
+
+    def __init__(self, resolve: Callable[[str], str]):
+        super().__init__()
+        self.resolve = resolve
+
+    def __missing__(self, key: str) -> str:
+        value = self[key] = self.resolve(key)
+        return value
+
 
 class TableMerger:
     """Service for merging multiple Coda tables into one"""
 
     def __init__(
         self,
-        api_token: str,
+        coda_client: CodaClient,
         destination_doc_id: str,
         destination_table_id: str,
         source_tables: list[SourceTable],
+        max_concurrent_requests: int = 5,
     ):
         """Initialize the table merger with configuration"""
-        self.coda_client = CodaClient(api_token=api_token)
+        self.coda_client = coda_client
+        # Upper bound on Coda reads in flight at once, to stay under rate limits
+        self.max_concurrent_requests = max_concurrent_requests
         self.destination_doc_id = destination_doc_id
         self.destination_table_id = destination_table_id
         self.source_tables = [
@@ -45,15 +80,34 @@ class TableMerger:
         )
 
         # Test source document access
-        for i, (doc_id, _, _) in enumerate(self.source_tables, 1):
-            doc_info = await self.coda_client.get_doc_info(doc_id)
+        source_doc_infos = await self.gather_limited(
+            *(
+                partial(self.coda_client.get_doc_info, doc_id)
+                for doc_id, _, _ in self.source_tables
+            ),
+        )
+        for i, doc_info in enumerate(source_doc_infos, 1):
             logger.info(
                 f"Successfully accessed source document {i}: {doc_info.get('name')}",
             )
 
         return True
 
-    # ... existing code ...
+    async def gather_limited(self, *factories: Callable[[], Awaitable[T]]) -> list[T]:
+        """
+        Run the awaitables made by the given factories concurrently, at most
+        max_concurrent_requests at a time.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+
+        async def run(factory: Callable[[], Awaitable[T]]) -> T:
+            async with semaphore:
+                # Only created once a slot is free, so cancelling a waiting run()
+                # never leaves a coroutine that was not awaited
+                return await factory()
+
+        # Cancels the remaining awaitables as soon as one of them fails
+        return await gather_or_cancel(*(run(factory) for factory in factories))
 
     async def detect_and_handle_duplicates(
         self,
@@ -62,54 +116,45 @@ class TableMerger:
         """Detect and handle duplicate unique keys in the destination table"""
         logger.info("Checking for duplicate unique keys in destination table...")
 
-        # Create a dictionary to track occurrences of each unique key
-        key_counts: dict[str, list[dict[str, Any]]] = {}
-        duplicate_rows: list[dict[str, Any]] = []
-
+        # Group rows by unique key in a single pass
+        rows_by_key: defaultdict[str, list[dict[str, Any]]] = defaultdict(list)
         for row in existing_rows:
             if unique_key := row["values"].get("unique_key"):
-                if unique_key in key_counts:
-                    key_counts[unique_key].append(row)
-                    duplicate_rows.append(row)
-                else:
-                    key_counts[unique_key] = [row]
-
-        # Filter to only keys with multiple rows
-        if duplicates := {k: v for k, v in key_counts.items() if len(v) > 1}:
+                rows_by_key[unique_key].append(row)
+
+        # Delete all but the LAST occurrence of each duplicate key
+        rows_to_delete = [
+            row for rows in rows_by_key.values() if len(rows) > 1 for row in rows[:-1]
+        ]
+
+        if rows_to_delete:
+            duplicate_key_count = sum(len(rows) > 1 for rows in rows_by_key.values())
             logger.info(
-                f"Found {len(duplicates)} unique keys with duplicates, "
-                f"affecting {len(duplicate_rows)} rows",
+                f"Found {duplicate_key_count} unique keys with duplicates, "
+                f"affecting {len(rows_to_delete)} rows",
             )
 
-            # Delete all but the LAST occurrence of each duplicate key
-            rows_to_delete = []
-            for rows in duplicates.values():
-                # Keep the last row, delete the rest
-                rows_to_delete.extend(rows[:-1])
-
-            if rows_to_delete:
-                # Delete rows in batches
-                row_ids = [row["id"] for row in rows_to_delete]
-                await self.coda_client.delete_rows(
-                    self.destination_doc_id,
-                    self.destination_table_id,
-                    row_ids,
-                )
-                logger.info(
-                    f"Deleted {len(rows_to_delete)} duplicate rows "
-                    "(keeping only the most recent occurrence)",
-                )
-
-                # Remove the deleted rows from the existing_rows list
-                deleted_ids = {row["id"] for row in rows_to_delete}
-                existing_rows = [
-                    row for row in existing_rows if row["id"] not in deleted_ids
-                ]
-
-                logger.info(
-                    "Updated existing_rows list "
-                    f"now contains {len(existing_rows)} rows",
-                )
+            # Delete rows in batches
+            row_ids = [row["id"] for row in rows_to_delete]
+            await self.coda_client.delete_rows(
+                self.destination_doc_id,
+                self.destination_table_id,
+                row_ids,
+            )
+            logger.info(
+                f"Deleted {len(rows_to_delete)} duplicate rows "
+                "(keeping only the most recent occurrence)",
+            )
+
+            # Remove the deleted rows from the existing_rows list
+            deleted_ids = set(row_ids)
+            existing_rows = [
+                row for row in existing_rows if row["id"] not in deleted_ids
+            ]
+
+            logger.info(
+                f"Updated existing_rows list now contains {len(existing_rows)} rows",
+            )
         else:
             logger.info("No duplicate unique keys found in destination table")
 
@@ -118,78 +163,70 @@ class TableMerger:
     @staticmethod
     def get_row_hash(row_values: dict[str, Any]) -> str:
         """Generate a hash for a row based on its values to detect changes"""
-        # Convert the row values to a string and hash it
-        row_str = json.dumps(row_values, sort_keys=True)
-        return hashlib.md5(row_str.encode()).hexdigest()  # noqa: S324
+        # Serialize the row values with sorted keys and hash them, a fast
+        # non-cryptographic hash is enough for change detection
+        row_bytes = orjson.dumps(row_values, option=orjson.OPT_SORT_KEYS)
+        return xxhash.xxh3_64_hexdigest(row_bytes)
 
-    def map_column_names(
-        self,
-        row_values: dict[str, Any],
-        destination_columns: set[str],
-    ) -> dict[str, Any]:
+    def build_column_name_map(self, destination_columns: set[str]) -> ColumnNameMap:
         """
-        Map source column names to destination column names using both explicit mappings
-        and automatic fuzzy matching based on case and special characters.
+        Build a source -> destination column name map for a fixed destination schema,
+        using both explicit mappings and automatic fuzzy matching based on case and
+        special characters. Each source column name is resolved on first lookup.
         """
-        mapped_values = {}
-
-        def normalize_column_name(name: str) -> str:
-            # Remove special characters and normalize spaces
-            return re.sub(
-                r"\s+",
-                " ",
-                name.lower().replace("/", "").replace("(", "").replace(")", ""),
-            ).strip()
+        normalized_destination_columns = {
+            normalize_column_name(col_name): col_name
+            for col_name in destination_columns
+        }
 
-        for col_name, value in row_values.items():
+        def resolve(col_name: str) -> str:
             # Case 1: If there's an explicit mapping, use it
             if col_name in self.column_mappings:
-                mapped_values[self.column_mappings[col_name]] = value
-                continue
+                return self.column_mappings[col_name]
 
             # Case 2: If the column name already exists in destination, use as is
             if col_name in destination_columns:
-                mapped_values[col_name] = value
-                continue
+                return col_name
 
             # Case 3: Try to find a match by normalizing names
-            normalized_source = normalize_column_name(col_name)
-            found_match = False
-
-            for dest_col in destination_columns:
-                normalized_dest = normalize_column_name(dest_col)
-                if normalized_source == normalized_dest:
-                    mapped_values[dest_col] = value
-                    found_match = True
-                    break
-
             # Case 4: If no match found, keep the original name
-            if not found_match:
-                mapped_values[col_name] = value
+            return normalized_destination_columns.get(
+                normalize_column_name(col_name),
+                col_name,
+            )
+
+        return ColumnNameMap(resolve)
 
-        return mapped_values
+    @staticmethod
+    def map_column_names(
+        row_values: dict[str, Any],
+        column_name_map: ColumnNameMap,
+    ) -> dict[str, Any]:
+        """Map source column names to destination column names"""
+        return {
+            column_name_map[col_name]: value for col_name, value in row_values.items()
+        }
 
     @staticmethod
-    def add_source_info_to_rows(
-        rows: list[dict[str, Any]],
+    def add_source_info_to_row(
+        row: dict[str, Any],
         source_id: str,
         project_name: str | None = None,
-    ) -> list[dict[str, Any]]:
-        """Add source information and hash to each row"""
-        for row in rows:
-            # Add source identifier to the row
-            row["source_id"] = source_id
-            # Add project name if provided
-            if project_name:
-                row["values"]["Project"] = project_name
-            # Add a unique key if it doesn't exist (using row ID as fallback)
-            if "unique_key" not in row.get("values", {}):
-                row_id = row.get("id", "")
-                # Try to create a unique key from the row data or use the row ID
-                row["values"]["unique_key"] = f"{source_id}_{row_id}"
-            # Add a hash of the row values to detect changes
-            row["hash"] = TableMerger.get_row_hash(row["values"])
-        return rows
+    ) -> dict[str, Any]:
+        """Add source information and hash to a row"""
+        # Add source identifier to the row
+        row["source_id"] = source_id
+        # Add project name if provided
+        if project_name:
+            row["values"]["Project"] = project_name
+        # Add a unique key if it doesn't exist (using row ID as fallback)
+        if "unique_key" not in row.get("values", {}):
+            row_id = row.get("id", "")
+            # Try to create a unique key from the row data or use the row ID
+            row["values"]["unique_key"] = f"{source_id}_{row_id}"
+        # Add a hash of the row values to detect changes
+        row["hash"] = TableMerger.get_row_hash(row["values"])
+        return row
 
     async def merge_tables(self) -> MergeResult:  # noqa: C901
         """Main function to merge multiple tables into one"""
@@ -236,6 +273,8 @@ class TableMerger:
         )
         destination_column_names = {col["name"] for col in destination_schema}
         logger.info(f"Destination table has {len(destination_column_names)} columns")
+        column_name_map = self.build_column_name_map(destination_column_names)
+        allowed_column_names = destination_column_names | _SPECIAL_COLUMNS
 
         # 1. Get existing rows from destination
         logger.info("Fetching existing rows from destination table...")
@@ -248,101 +287,104 @@ class TableMerger:
         # Check for and handle duplicate unique keys
         existing_rows = await self.detect_and_handle_duplicates(existing_rows)
 
-        # Create a dictionary of existing rows by unique key
-        existing_by_key: dict[str, dict[str, Any]] = {}
+        # Index existing row IDs and hashes by unique key
+        existing_id_by_key: dict[str, str] = {}
+        existing_hash_by_key: dict[str, str] = {}
         for row in existing_rows:
             if unique_key := row["values"].get("unique_key"):
-                existing_by_key[unique_key] = row
+                existing_id_by_key[unique_key] = row["id"]
+                existing_hash_by_key[unique_key] = row["values"].get("row_hash", "")
 
         # 2. Fetch all source rows with their hashes
         all_source_rows: list[dict[str, Any]] = []
-        source_keys: set[str] = set()  # Track all keys from source tables
+        # Parallel arrays of the keyed source rows, their unique keys and hashes
+        source_keys: list[str] = []
+        source_hashes: list[str] = []
+        keyed_source_rows: list[dict[str, Any]] = []
+
+        logger.info(f"Fetching data from {len(self.source_tables)} source tables...")
+        source_rows = await self.gather_limited(
+            *(
+                partial(self.coda_client.get_table_data, doc_id, table_id)
+                for doc_id, table_id, _ in self.source_tables
+            ),
+        )
 
-        for i, (doc_id, table_id, project_name) in enumerate(self.source_tables, 1):
-            logger.info(
-                f"Fetching data from source {i}: Doc {doc_id}, Table {table_id}...",
-            )
-            rows = await self.coda_client.get_table_data(doc_id, table_id)
+        for i, ((doc_id, table_id, project_name), rows) in enumerate(
+            zip(self.source_tables, source_rows),
+            1,
+        ):
             source_id = f"src_{doc_id}_{table_id}"
 
             # Use the project name from config or default
             project = project_name or f"Project {i}"
 
-            # Apply column name mapping before adding source info
+            # Process every row in a single pass
             for row in rows:
-                row["values"] = self.map_column_names(
-                    row["values"],
-                    destination_column_names,
-                )
-
-            processed_rows = self.add_source_info_to_rows(rows, source_id, project)
+                # Apply column name mapping before adding source info
+                row["values"] = self.map_column_names(row["values"], column_name_map)
+                self.add_source_info_to_row(row, source_id, project)
 
-            # Filter out columns that don't exist in the destination table
-            for row in processed_rows:
-                filtered_values: dict[str, Any] = {
+                # Filter out columns that don't exist in the destination table
+                row["values"] = {
                     col_name: value
                     for col_name, value in row["values"].items()
-                    if col_name in destination_column_names
-                    or col_name
-                    in [
-                        "unique_key",
-                        "row_hash",
-                    ]
+                    if col_name in allowed_column_names
                 }
-                row["values"] = filtered_values
+                all_source_rows.append(row)
 
-            all_source_rows.extend(processed_rows)
-
-            # Add keys to the tracking set
-            for row in processed_rows:
+                # Track the rows that can be matched against the destination
                 if unique_key := row["values"].get("unique_key"):
-                    source_keys.add(unique_key)
+                    source_keys.append(unique_key)
+                    source_hashes.append(row["hash"])
+                    keyed_source_rows.append(row)
 
             logger.info(f"Retrieved {len(rows)} rows from source {i}")
 
         # 3. Determine which rows to add, update, or delete
         rows_to_add: list[dict[str, Any]] = []
         rows_to_update: list[dict[str, Any]] = []
-        rows_to_delete: list[dict[str, Any]] = []
+        # Destination rows not matched by any source row yet, i.e. the deletions
+        unmatched_id_by_key = existing_id_by_key.copy()
 
         # Find rows to add or update
-        for row in all_source_rows:
-            unique_key = row["values"].get("unique_key")
-            if not unique_key:
-                continue
-
+        for unique_key, row_hash, row in zip(
+            source_keys,
+            source_hashes,
+            keyed_source_rows,
+        ):
             # Add the hash to the values for storage
-            row["values"]["row_hash"] = row["hash"]
+            row["values"]["row_hash"] = row_hash
 
-            if unique_key not in existing_by_key:
+            # Hashes are always strings, so None means the key is new
+            existing_hash = existing_hash_by_key.get(unique_key)
+            if existing_hash is None:
                 # This is a new row
                 rows_to_add.append(row)
-            else:
-                # This is an existing row, check if it changed
-                existing_row = existing_by_key[unique_key]
-                existing_hash = existing_row["values"].get("row_hash", "")
+                continue
 
-                if row["hash"] != existing_hash:
-                    # Row has changed, update it
-                    row["id"] = existing_row["id"]  # Keep the existing row ID
-                    rows_to_update.append(row)
+            # Several source rows may share a key, so only the first one pops it
+            unmatched_id_by_key.pop(unique_key, None)
+
+            # This is an existing row, check if it changed
+            if row_hash != existing_hash:
+                # Row has changed, update it and keep the existing row ID
+                row["id"] = existing_id_by_key[unique_key]
+                rows_to_update.append(row)
 
         # Find rows to delete (in destination but not in source)
-        rows_to_delete.extend(
-            row
-            for unique_key, row in existing_by_key.items()
-            if unique_key not in source_keys
-        )
+        row_ids_to_delete = list(unmatched_id_by_key.values())
 
         # 4. Apply the changes
         logger.info(
             f"Changes to apply: "
             f"{len(rows_to_add)} new, "
             f"{len(rows_to_update)} updates, "
-            f"{len(rows_to_delete)} deletions",
+            f"{len(row_ids_to_delete)} deletions",
         )
 
-        # Add new rows and update existing ones
+        # Add new rows and update existing ones. The counts in the result are per
+        # source row, while upsert_rows only writes the last row sharing a key.
         if rows_to_add or rows_to_update:
             await self.coda_client.upsert_rows(
                 self.destination_doc_id,
@@ -352,14 +394,13 @@ class TableMerger:
             )
 
         # Delete removed rows
-        if rows_to_delete:
-            row_ids = [row["id"] for row in rows_to_delete]
+        if row_ids_to_delete:
             await self.coda_client.delete_rows(
                 self.destination_doc_id,
                 self.destination_table_id,
-                row_ids,
+                row_ids_to_delete,
             )
-            logger.info(f"Deleted {len(rows_to_delete)} removed rows")
+            logger.info(f"Deleted {len(row_ids_to_delete)} removed rows")
 
         logger.info("Merge completed successfully!")
         return MergeResult(
@@ -367,6 +408,6 @@ class TableMerger:
             totalRowsProcessed=len(all_source_rows),
             newRows=len(rows_to_add),
             updatedRows=len(rows_to_update),
-            deletedRows=len(rows_to_delete),
+            deletedRows=len(row_ids_to_delete),
             destinationTableId=self.destination_table_id,
         )
@@ -0,0 +1,58 @@
+from collections import OrderedDict
+
+import pytest
+
+from main import app, config
+from main.controllers import coda_controller
+from main.schemas.coda_schemas import MergeResult
+from main.services.coda_client import CodaClient
+from main.services.table_merger import TableMerger
+
+
+MERGE_RESULT = MergeResult(
+    success=True,
+    totalRowsProcessed=3,
+    newRows=1,
+    updatedRows=1,
+    deletedRows=1,
+    destinationTableId="dest-table",
+)
+
+
+@pytest.fixture(autouse=True)
+def coda_client(mocker, monkeypatch):
+    # The test client doesn't run the lifespan that sets up the shared client
+    client = mocker.create_autospec(CodaClient, instance=True)
+    monkeypatch.setattr(app.state, "coda_client", client, raising=False)
+    monkeypatch.setattr(coda_controller, "rate_limit_store", OrderedDict())
+    return client
+
+
+@pytest.fixture
+def merge_tables(mocker):
+    return mocker.patch.object(TableMerger, "merge_tables", return_value=MERGE_RESULT)
+
+
+async def test_merge_requires_api_key(client, merge_tables):
+    response = await client.post("/coda/merge")
+    assert response.status_code == 401
+
+    response = await client.post("/coda/merge", headers={"X-API-Key": "wrong"})
+    assert response.status_code == 403
+
+    merge_tables.assert_not_awaited()
+
+
+async def test_merge(client, coda_client, merge_tables, mocker):
+    merger_init = mocker.spy(TableMerger, "__init__")
+
+    response = await client.post("/coda/merge", headers={"X-API-Key": config.API_KEY})
+
+    assert response.status_code == 200
+    assert response.json() == MERGE_RESULT.model_dump()
+    assert merger_init.call_args.kwargs["coda_client"] is coda_client
+
+    # A second request within the rate limit window is rejected
+    response = await client.post("/coda/merge", headers={"X-API-Key": config.API_KEY})
+    assert response.status_code == 429
+    merge_tables.assert_awaited_once()
@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+from main.libs.tasks import gather_or_cancel
+
+
+async def test_gather_or_cancel_returns_results_in_order():
+    async def delayed(value, delay):
+        await asyncio.sleep(delay)
+        return value
+
+    results = await gather_or_cancel(delayed(1, 0.02), delayed(2, 0), delayed(3, 0.01))
+    assert results == [1, 2, 3]
+
+    assert await gather_or_cancel() == []
+
+
+async def test_gather_or_cancel_cancels_pending_on_failure():
+    cancelled = asyncio.Event()
+
+    async def fail():
+        raise ValueError("boom")
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    with pytest.raises(ValueError, match="boom"):
+        await gather_or_cancel(slow(), fail())
+
+    assert cancelled.is_set()
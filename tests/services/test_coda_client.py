@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from main.services.coda_client import CodaClient
+
+
+@pytest.fixture
+async def coda_client():
+    client = CodaClient(api_token="token")
+    yield client
+    await client.aclose()
+
+
+async def test_upsert_rows_sends_last_row_per_key(coda_client, mocker):
+    make_request = mocker.patch.object(coda_client, "make_request", return_value={})
+    rows = [
+        {"values": {"unique_key": "a", "Name": "first", "id": "r1"}},
+        {"values": {"unique_key": "b", "Name": "other"}},
+        {"values": {"unique_key": "a", "Name": "second"}},
+    ]
+
+    await coda_client.upsert_rows("doc", "table", rows, ["unique_key"])
+
+    make_request.assert_awaited_once()
+    payload = make_request.await_args.kwargs["data"]
+    assert payload["keyColumns"] == ["unique_key"]
+    assert [row["cells"] for row in payload["rows"]] == [
+        [
+            {"column": "unique_key", "value": "a"},
+            {"column": "Name", "value": "second"},
+        ],
+        [
+            {"column": "unique_key", "value": "b"},
+            {"column": "Name", "value": "other"},
+        ],
+    ]
+    # The caller's rows are left untouched
+    assert rows[0]["values"]["id"] == "r1"
+
+
+async def test_delete_rows_cancels_pending_batches_on_failure(coda_client, mocker):
+    cancelled = asyncio.Event()
+
+    async def make_request(method, endpoint, data, parse_response):
+        if data["rowIds"][0] == "row-0":
+            raise RuntimeError("Request failed after 3 attempts")
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    mocker.patch.object(coda_client, "make_request", side_effect=make_request)
+
+    with pytest.raises(RuntimeError):
+        await coda_client.delete_rows(
+            "doc",
+            "table",
+            [f"row-{i}" for i in range(80)],
+        )
+
+    assert cancelled.is_set()
@@ -0,0 +1,262 @@
+import asyncio
+from functools import partial
+
+import pytest
+
+from main.schemas.config import SourceTable
+from main.services.coda_client import CodaClient
+from main.services.table_merger import ColumnNameMap, TableMerger
+
+
+DESTINATION_DOC_ID = "dest-doc"
+DESTINATION_TABLE_ID = "dest-table"
+SOURCE_TABLE = SourceTable(doc_id="src-doc", table_id="src-table", project="Proj")
+DESTINATION_COLUMNS = ["Name", "Project", "unique_key", "row_hash"]
+
+
+def source_row(row_id, unique_key, name):
+    return {"id": row_id, "values": {"unique_key": unique_key, "Name": name}}
+
+
+def destination_row(row_id, unique_key, row_hash):
+    return {"id": row_id, "values": {"unique_key": unique_key, "row_hash": row_hash}}
+
+
+def row_hash(unique_key, name):
+    return TableMerger.get_row_hash(
+        {"Name": name, "Project": SOURCE_TABLE.project, "unique_key": unique_key},
+    )
+
+
+@pytest.fixture
+def coda_client(mocker):
+    client = mocker.create_autospec(CodaClient, instance=True)
+    client.get_user_info.return_value = {"name": "Tester"}
+    client.get_doc_info.return_value = {"name": "Doc"}
+    client.get_table_info.return_value = {"name": "Table"}
+    client.get_table_schema.return_value = [
+        {"name": name, "type": "text"} for name in DESTINATION_COLUMNS
+    ]
+    return client
+
+
+@pytest.fixture
+def merger(coda_client):
+    return TableMerger(
+        coda_client=coda_client,
+        destination_doc_id=DESTINATION_DOC_ID,
+        destination_table_id=DESTINATION_TABLE_ID,
+        source_tables=[SOURCE_TABLE],
+    )
+
+
+def set_table_data(coda_client, destination_rows, source_rows):
+    tables = {
+        (DESTINATION_DOC_ID, DESTINATION_TABLE_ID): destination_rows,
+        (SOURCE_TABLE.doc_id, SOURCE_TABLE.table_id): source_rows,
+    }
+    coda_client.get_table_data.side_effect = lambda doc_id, table_id: tables[
+        (doc_id, table_id)
+    ]
+
+
+def upserted_rows(coda_client):
+    coda_client.upsert_rows.assert_awaited_once()
+    doc_id, table_id, rows, key_columns = coda_client.upsert_rows.await_args.args
+    assert (doc_id, table_id, key_columns) == (
+        DESTINATION_DOC_ID,
+        DESTINATION_TABLE_ID,
+        ["unique_key"],
+    )
+    return rows
+
+
+async def test_merge_tables(coda_client, merger):
+    set_table_data(
+        coda_client,
+        destination_rows=[
+            destination_row("d-unchanged", "unchanged", row_hash("unchanged", "B")),
+            destination_row("d-changed", "changed", "stale-hash"),
+            destination_row("d-removed", "removed", "any-hash"),
+        ],
+        source_rows=[
+            source_row("s-new", "new", "A"),
+            source_row("s-unchanged", "unchanged", "B"),
+            source_row("s-changed", "changed", "C"),
+        ],
+    )
+
+    result = await merger.merge_tables()
+
+    assert result.totalRowsProcessed == 3
+    assert result.newRows == 1
+    assert result.updatedRows == 1
+    assert result.deletedRows == 1
+    assert result.destinationTableId == DESTINATION_TABLE_ID
+
+    new_row, changed_row = upserted_rows(coda_client)
+    assert new_row["values"] == {
+        "Name": "A",
+        "Project": "Proj",
+        "unique_key": "new",
+        "row_hash": row_hash("new", "A"),
+    }
+    assert new_row["id"] == "s-new"
+    assert changed_row["values"]["unique_key"] == "changed"
+    assert changed_row["id"] == "d-changed"
+
+    coda_client.delete_rows.assert_awaited_once_with(
+        DESTINATION_DOC_ID,
+        DESTINATION_TABLE_ID,
+        ["d-removed"],
+    )
+
+
+async def test_merge_tables_without_changes(coda_client, merger):
+    set_table_data(
+        coda_client,
+        destination_rows=[destination_row("d-1", "key", row_hash("key", "A"))],
+        source_rows=[source_row("s-1", "key", "A")],
+    )
+
+    result = await merger.merge_tables()
+
+    assert (result.newRows, result.updatedRows, result.deletedRows) == (0, 0, 0)
+    coda_client.upsert_rows.assert_not_awaited()
+    coda_client.delete_rows.assert_not_awaited()
+
+
+async def test_merge_tables_source_rows_sharing_existing_key(coda_client, merger):
+    set_table_data(
+        coda_client,
+        destination_rows=[destination_row("d-1", "shared", "stale-hash")],
+        source_rows=[
+            source_row("s-1", "shared", "first"),
+            source_row("s-2", "shared", "second"),
+        ],
+    )
+
+    result = await merger.merge_tables()
+
+    assert (result.newRows, result.updatedRows, result.deletedRows) == (0, 2, 0)
+    # Sent in source order, so the last source row wins
+    assert [row["values"]["Name"] for row in upserted_rows(coda_client)] == [
+        "first",
+        "second",
+    ]
+    coda_client.delete_rows.assert_not_awaited()
+
+
+async def test_merge_tables_removes_destination_duplicates(coda_client, merger):
+    set_table_data(
+        coda_client,
+        destination_rows=[
+            destination_row("d-old", "dup", "stale-hash"),
+            destination_row("d-latest", "dup", row_hash("dup", "A")),
+        ],
+        source_rows=[source_row("s-1", "dup", "A")],
+    )
+
+    result = await merger.merge_tables()
+
+    # Only the most recent duplicate is kept and it matches the source row
+    coda_client.delete_rows.assert_awaited_once_with(
+        DESTINATION_DOC_ID,
+        DESTINATION_TABLE_ID,
+        ["d-old"],
+    )
+    assert (result.newRows, result.updatedRows, result.deletedRows) == (0, 0, 0)
+    coda_client.upsert_rows.assert_not_awaited()
+
+
+async def test_detect_and_handle_duplicates(coda_client, merger):
+    rows = [
+        destination_row("d-1", "dup", "h1"),
+        destination_row("d-2", "unique", "h2"),
+        destination_row("d-3", "dup", "h3"),
+        destination_row("d-4", "dup", "h4"),
+        {"id": "d-5", "values": {}},
+    ]
+
+    remaining_rows = await merger.detect_and_handle_duplicates(rows)
+
+    coda_client.delete_rows.assert_awaited_once_with(
+        DESTINATION_DOC_ID,
+        DESTINATION_TABLE_ID,
+        ["d-1", "d-3"],
+    )
+    assert [row["id"] for row in remaining_rows] == ["d-2", "d-4", "d-5"]
+
+
+async def test_detect_and_handle_duplicates_without_duplicates(coda_client, merger):
+    rows = [destination_row("d-1", "a", "h1"), destination_row("d-2", "b", "h2")]
+
+    assert await merger.detect_and_handle_duplicates(rows) == rows
+    coda_client.delete_rows.assert_not_awaited()
+
+
+def test_column_name_map(merger):
+    merger.column_mappings = {"Old Name": "Name"}
+    column_name_map = merger.build_column_name_map({"Name", "Due Date (UTC)"})
+
+    # Explicit mapping, exact match, normalized match, then the name as is
+    assert column_name_map["Old Name"] == "Name"
+    assert column_name_map["Name"] == "Name"
+    assert column_name_map["due  date (utc)"] == "Due Date (UTC)"
+    assert column_name_map["Other"] == "Other"
+
+    assert dict(column_name_map) == {
+        "Old Name": "Name",
+        "Name": "Name",
+        "due  date (utc)": "Due Date (UTC)",
+        "Other": "Other",
+    }
+
+
+def test_column_name_map_resolves_each_name_once(mocker):
+    resolve = mocker.Mock(side_effect=str.upper)
+    column_name_map = ColumnNameMap(resolve)
+
+    assert column_name_map["a"] == "A"
+    assert column_name_map["a"] == "A"
+    assert column_name_map["b"] == "B"
+    assert resolve.call_args_list == [mocker.call("a"), mocker.call("b")]
+
+
+def test_map_column_names(merger):
+    column_name_map = merger.build_column_name_map({"Name"})
+
+    assert merger.map_column_names({"name": "A", "Extra": 1}, column_name_map) == {
+        "Name": "A",
+        "Extra": 1,
+    }
+
+
+async def test_gather_limited_cancels_waiting_factories_on_failure(coda_client):
+    merger = TableMerger(
+        coda_client=coda_client,
+        destination_doc_id=DESTINATION_DOC_ID,
+        destination_table_id=DESTINATION_TABLE_ID,
+        source_tables=[SOURCE_TABLE],
+        max_concurrent_requests=2,
+    )
+    created = []
+    started = []
+
+    async def fetch(i):
+        started.append(i)
+        if i == 0:
+            raise ValueError("boom")
+        await asyncio.sleep(10)
+
+    def make_fetch(i):
+        created.append(i)
+        return fetch(i)
+
+    with pytest.raises(ValueError, match="boom"):
+        await merger.gather_limited(*(partial(make_fetch, i) for i in range(6)))
+
+    # Awaitables still waiting for a slot were never created, so every created
+    # coroutine was awaited and none is left to warn about
+    assert len(created) < 6
+    assert created == started